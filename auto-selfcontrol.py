@@ -2,20 +2,52 @@
 
 import subprocess
 import os
-import json
 import time
 from datetime import datetime
 import plistlib
 import logging.handlers
 import traceback
 import sys
-import re
+import tempfile
+from functools import lru_cache
 from Foundation import NSUserDefaults, CFPreferencesSetAppValue, CFPreferencesAppSynchronize, NSDate
 from pwd import getpwnam
 from optparse import OptionParser
 
+try:
+    import orjson as _json
+
+    def dump_json(obj):
+        """Serialize obj to UTF-8 encoded JSON"""
+        return _json.dumps(obj)
+except ImportError:
+    import json as _json
+
+    def dump_json(obj):
+        """Serialize obj to UTF-8 encoded JSON"""
+        return _json.dumps(obj).encode('UTF-8')
+
 SETTINGS_DIR = os.path.expanduser("~") + '/.config/auto-selfcontrol'
 
+ALL_WEEKDAYS = range(1, 8)
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# Blocklist plist as written by plistlib.dumps, used for small host lists
+BLOCKLIST_TEMPLATE_MAX_HOSTS = 100
+BLOCKLIST_TEMPLATE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+\t<key>BlockAsWhitelist</key>
+\t<%b/>
+\t<key>HostBlacklist</key>
+\t<array>
+%b\t</array>
+</dict>
+</plist>
+'''
+
 # Configure global logger
 LOGGER = logging.getLogger("Auto-SelfControl")
 LOGGER.setLevel(logging.INFO)
@@ -29,35 +61,42 @@ def load_config(path):
     config = dict()
 
     try:
-        with open(path, 'rt') as cfg:
-            config.update(json.load(cfg))
-    except ValueError as exception:
+        # unbuffered: readall() reads the whole file into a single buffer sized by fstat
+        with open(path, 'rb', buffering=0) as cfg:
+            data = cfg.read()
+        config.update(_json.loads(data))
+    except (TypeError, ValueError) as exception:
         exit_with_error("The JSON config file {configfile} is not correctly formatted."
                         "The following exception was raised:\
                         \n{exc}".format(configfile=path, exc=exception))
 
     return config
 
-def run(settings_dir):
+def run(settings_dir, preloaded=None):
     """Load config and start SelfControl"""
-    run_config = "{path}/run_config.json".format(path=settings_dir)
-    if not os.path.exists(run_config):
-        exit_with_error(
-            "Run config file could not be found in installation location, please make sure that you have Auto-SelfControl activated/installed")
+    if preloaded is not None:
+        # the installer passes the config it just saved and has already checked that SelfControl is not running
+        config = preloaded
+    else:
+        run_config = "{path}/run_config.json".format(path=settings_dir)
+        try:
+            config = load_config(run_config)
+        except FileNotFoundError:
+            exit_with_error(
+                "Run config file could not be found in installation location, please make sure that you have Auto-SelfControl activated/installed")
 
-    config = load_config(run_config)
+        if check_if_running(config):
+            print("SelfControl is already running, exit")
+            LOGGER.error(
+                "SelfControl is already running, ignore current execution of Auto-SelfControl.")
+            exit(2)
 
     """Start SelfControl with custom parameters, depending on the weekday and the config"""
 
-    if check_if_running(config):
-        print("SelfControl is already running, exit")
-        LOGGER.error(
-            "SelfControl is already running, ignore current execution of Auto-SelfControl.")
-        exit(2)
-
+    now = get_minute_of_week(time.localtime())
     try:
         schedule = next(
-            s for s in config["block-schedules"] if is_schedule_active(s))
+            s for s in config["block-schedules"] if is_schedule_active(s, now))
     except StopIteration:
         print("No Schedule is active at the moment.")
         LOGGER.warn("No schedule is active at the moment. Shutting down.")
@@ -75,143 +114,150 @@ def run(settings_dir):
         end=block_end_date))
 
 
-def get_selfcontrol_out_pattern(content_pattern):
-    """Returns a RegEx pattern that matches SelfControl's output with the provided content_pattern"""
-    return r'^.*org\.eyebeam\.SelfControl[^ ]+\s*' + content_pattern + r'\s*$'
-
-
 def check_if_running(config):
     """Check if SelfControl is already running."""
-    output = execSelfControl(config, ["--is-running"]).decode('UTF-8')
-    m = re.search(
-        get_selfcontrol_out_pattern(r'(NO|YES)'), output, re.MULTILINE)
-    if m is None:
-        exit_with_error("Could not detect if SelfControl is running.")
-    return m.groups()[0] != 'NO'
-
-
-def is_schedule_active(schedule):
-    """Check if we are right now in the provided schedule or not."""
-    currenttime = datetime.today()
-    starttime = datetime(currenttime.year, currenttime.month, currenttime.day, schedule["start-hour"],
-                         schedule["start-minute"])
-    endtime = datetime(currenttime.year, currenttime.month, currenttime.day, schedule["end-hour"],
-                       schedule["end-minute"])
-    d = endtime - starttime
+    for line in execSelfControl(config, ["--is-running"]).splitlines():
+        if b'org.eyebeam.SelfControl' not in line:
+            continue
+        # the state is the only token after SelfControl's "[pid:tid]" log prefix
+        state = line.rsplit(b']', 1)[-1].strip()
+        if state == b'YES':
+            return True
+        if state == b'NO':
+            return False
+
+    exit_with_error("Could not detect if SelfControl is running.")
+
+
+def is_schedule_active(schedule, now=None):
+    """Check if we are right now (or at the provided minute of the week) in the provided schedule or not."""
+    if now is None:
+        now = get_minute_of_week(time.localtime())
+    for start, end in get_schedule_windows(schedule):
+        # windows of schedules spanning Saturday midnight end in the next week
+        if start <= now < end or start <= now + MINUTES_PER_WEEK < end:
+            return True
 
-    for weekday in get_schedule_weekdays(schedule):
-        weekday_diff = currenttime.isoweekday() % 7 - weekday % 7
+    return False
 
-        if weekday_diff == 0:
-            # schedule's weekday is today
-            result = starttime <= currenttime and endtime >= currenttime if d.days == 0 else starttime <= currenttime
-        elif weekday_diff == 1 or weekday_diff == -6:
-            # schedule's weekday was yesterday
-            result = d.days != 0 and currenttime <= endtime
-        else:
-            # schedule's weekday was on any other day.
-            result = False
 
-        if result:
-            return result
+def get_minute_of_week(localtime):
+    """Return the minutes passed since Sunday 00:00 for the provided struct_time."""
+    # tm_wday starts with Monday = 0, schedules use Sunday = 0 (or 7)
+    return (localtime.tm_wday + 1) % 7 * MINUTES_PER_DAY + localtime.tm_hour * 60 + localtime.tm_min
 
-    return False
+
+def get_schedule_windows(schedule):
+    """Return the (start, end) minute-of-week ranges in which the specified schedule is active."""
+    start = schedule["start-hour"] * 60 + schedule["start-minute"]
+    end = schedule["end-hour"] * 60 + schedule["end-minute"]
+    if end < start:
+        # schedule spans midnight and ends on the following day
+        end += MINUTES_PER_DAY
+
+    for weekday in get_schedule_weekdays(schedule):
+        day = (weekday % 7) * MINUTES_PER_DAY
+        yield day + start, day + end
 
 def get_end_date_of_schedule(schedule):
     """Return the end date of the provided schedule in ISO 8601 format"""
-    currenttime = datetime.today()
-    endtime = datetime(
-        currenttime.year, currenttime.month, currenttime.day, schedule['end-hour'], schedule['end-minute'])
-    # manually create ISO8601 string because of tz issues with Python2
-    ts = time.time()
-    utc_offset = ((datetime.fromtimestamp(
-        ts) - datetime.utcfromtimestamp(ts)).total_seconds()) / 3600
-    offset = str(int(abs(utc_offset * 100))).zfill(4)
-    sign = "+" if utc_offset >= 0 else "-"
-
-    return endtime.strftime("%Y-%m-%dT%H:%M:%S{sign}{offset}".format(sign=sign, offset=offset))
+    endtime = datetime.now().astimezone().replace(
+        hour=schedule['end-hour'], minute=schedule['end-minute'], second=0, microsecond=0)
+    return endtime.strftime("%Y-%m-%dT%H:%M:%S%z")
 
 
 def get_schedule_weekdays(schedule):
     """Return a list of weekdays the specified schedule is active."""
-    return [schedule["weekday"]] if schedule.get("weekday", None) is not None else range(1, 8)
+    return [schedule["weekday"]] if schedule.get("weekday", None) is not None else ALL_WEEKDAYS
 
 
 def get_launchscript(config, settings_dir):
-    """Return the string of the launchscript."""
-    return '''<?xml version="1.0" encoding="UTF-8"?>
-    <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
-    <plist version="1.0">
-    <dict>
-        <key>Label</key>
-        <string>com.parrot-bytes.auto-selfcontrol</string>
-        <key>ProgramArguments</key>
-        <array>
-            <string>/usr/bin/python</string>
-            <string>{path}</string>
-            <string>--run</string>
-            <string>--dir</string>
-            <string>{dir}</string>
-        </array>
-        <key>StartCalendarInterval</key>
-        <array>
-            {startintervals}</array>
-        <key>RunAtLoad</key>
-        <true/>
-    </dict>
-    </plist>'''.format(path=os.path.realpath(__file__), startintervals="".join(get_launchscript_startintervals(config)), dir=settings_dir)
+    """Return the launchscript as serialized plist."""
+    return plistlib.dumps({
+        "Label": "com.parrot-bytes.auto-selfcontrol",
+        "ProgramArguments": [
+            "/usr/bin/python",
+            os.path.realpath(__file__),
+            "--run",
+            "--dir",
+            settings_dir
+        ],
+        "StartCalendarInterval": get_launchscript_startintervals(config),
+        "RunAtLoad": True,
+        # launchd throttles CPU and I/O of background jobs by default, which
+        # makes starting SelfControl noticeably slower. The job only runs
+        # briefly at the scheduled start times, so lifting the limits is cheap.
+        "ProcessType": "Interactive"
+    })
 
 
 def get_launchscript_startintervals(config):
-    """Return the string of the launchscript start intervals."""
-    for schedule in config["block-schedules"]:
-        for weekday in get_schedule_weekdays(schedule):
-            yield '''<dict>
-                    <key>Weekday</key>
-                    <integer>{weekday}</integer>
-                    <key>Minute</key>
-                    <integer>{startminute}</integer>
-                    <key>Hour</key>
-                    <integer>{starthour}</integer>
-                </dict>
-                '''.format(weekday=weekday, startminute=schedule['start-minute'], starthour=schedule['start-hour'])
+    """Return the list of the launchscript start intervals."""
+    return [{"Weekday": weekday, "Minute": schedule["start-minute"], "Hour": schedule["start-hour"]}
+            for schedule in config["block-schedules"]
+            for weekday in get_schedule_weekdays(schedule)]
+
+
+@lru_cache(maxsize=8)
+def get_user_id(username):
+    """Return the uid of the provided user as a string."""
+    return str(getpwnam(username).pw_uid)
+
+
+@lru_cache(maxsize=4)
+def get_selfcontrol_binary(selfcontrol_path):
+    """Return the path of the SelfControl executable inside the app bundle."""
+    return os.path.join(selfcontrol_path, "Contents/MacOS/org.eyebeam.SelfControl")
 
 
 def execSelfControl(config, arguments):
-    user_id = str(getpwnam(config["username"]).pw_uid)
-    output = subprocess.check_output(
-        ["{path}/Contents/MacOS/org.eyebeam.SelfControl".format(
-            path=config["selfcontrol-path"]), user_id] + arguments,
-        stderr=subprocess.STDOUT
-    )
-    return output
+    # SelfControl reports its state through NSLog on stderr, so keep it merged into stdout
+    return subprocess.run(
+        [get_selfcontrol_binary(config["selfcontrol-path"]), get_user_id(config["username"]), *arguments],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        check=True
+    ).stdout
+
+
+def write_file_atomically(path, data):
+    """Write data to a temporary file next to path and move it into place, so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            os.fchmod(fp.fileno(), 0o644)
+            fp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
 def install(config, settings_dir):
     """ installs auto-selfcontrol """
     print("> Start installation of Auto-SelfControl")
 
+    try:
+        run_config = dump_json(config)
+    except (TypeError, ValueError) as exception:
+        exit_with_error("The configuration could not be saved as JSON. "
+                        "The following exception was raised:\n{exc}".format(exc=exception))
+
     launchplist_path = "/Library/LaunchDaemons/com.parrot-bytes.auto-selfcontrol.plist"
 
     # Check for existing plist
     if os.path.exists(launchplist_path):
-        print("> Removed previous installation files")
+        print("> Unloaded previous installation")
         subprocess.call(["launchctl", "unload", "-w", launchplist_path])
-        os.unlink(launchplist_path)
 
-    launchplist_script = get_launchscript(config, settings_dir)
-
-    with open(launchplist_path, 'w') as myfile:
-        myfile.write(launchplist_script)
+    write_file_atomically(launchplist_path, get_launchscript(config, settings_dir))
 
     subprocess.call(["launchctl", "load", "-w", launchplist_path])
 
     print("> Save run configuration")
-    if not os.path.exists(settings_dir):
-        os.makedirs(settings_dir)
+    os.makedirs(settings_dir, exist_ok=True)
 
-    with open("{dir}/run_config.json".format(dir=settings_dir), 'w') as fp:
-        fp.write(json.dumps(config))
+    write_file_atomically("{dir}/run_config.json".format(dir=settings_dir), run_config)
 
     print("> Installed\n")
 
@@ -220,7 +266,7 @@ def check_config(config):
     """ checks whether the config file is correct """
     if "username" not in config:
         exit_with_error("No username specified in config.")
-    if config["username"].encode('UTF-8') not in get_osx_usernames():
+    if config["username"] not in get_osx_usernames():
         exit_with_error(
             "Username '{username}' unknown.\nPlease use your OSX username instead.\n"
             "If you have trouble finding it, just enter the command 'whoami'\n"
@@ -248,17 +294,34 @@ def check_config(config):
 
 def update_blocklist(blocklist_path, config, schedule):
     """Save the blocklist with the current configuration"""
-    plist = {
-        "HostBlacklist": config["host-blacklist"],
-        "BlockAsWhitelist": schedule.get("block-as-whitelist", False)
-    }
-    with open(blocklist_path, 'wb') as fp:
-        plistlib.dump(plist, fp)
+    write_file_atomically(blocklist_path, serialize_blocklist(
+        config["host-blacklist"], schedule.get("block-as-whitelist", False)))
+
+
+def serialize_blocklist(hosts, block_as_whitelist):
+    """Return the SelfControl blocklist for the provided hosts as serialized plist."""
+    if 0 < len(hosts) <= BLOCKLIST_TEMPLATE_MAX_HOSTS and isinstance(block_as_whitelist, bool) \
+            and all(is_plain_host(host) for host in hosts):
+        return BLOCKLIST_TEMPLATE % (
+            b'true' if block_as_whitelist else b'false',
+            b''.join([b'\t\t<string>' + host.encode('ascii') + b'</string>\n' for host in hosts]))
+
+    return plistlib.dumps({
+        "HostBlacklist": hosts,
+        "BlockAsWhitelist": block_as_whitelist
+    })
 
 
+def is_plain_host(host):
+    """Check if the host can be put into the blocklist template without XML escaping."""
+    return isinstance(host, str) and host.isascii() and host.isprintable() \
+        and not any(c in host for c in '&<>')
+
+
+@lru_cache(maxsize=1)
 def get_osx_usernames():
     output = subprocess.check_output(["dscl", ".", "list", "/users"])
-    return [s.strip() for s in output.splitlines()]
+    return frozenset(s.decode('UTF-8', 'replace').strip() for s in output.splitlines())
 
 
 def excepthook(excType, excValue, tb):
@@ -297,21 +360,22 @@ if __name__ == "__main__":
         run(OPTS.dir)
     elif OPTS.install:
         CONFIG_FILE = "{path}/config.json".format(path=OPTS.dir)
-        if not os.path.exists(CONFIG_FILE):
+        try:
+            CONFIG = load_config(CONFIG_FILE)
+        except FileNotFoundError:
             exit_with_error(
                 "There was no config file found in {dir}, please create a config file.".format(dir=OPTS.dir))
-
-        CONFIG = load_config(CONFIG_FILE)
         check_config(CONFIG)
 
         install(CONFIG, OPTS.dir)
+        NOW = get_minute_of_week(time.localtime())
         schedule_is_active = any(
-            s for s in CONFIG["block-schedules"] if is_schedule_active(s))
+            is_schedule_active(s, NOW) for s in CONFIG["block-schedules"])
 
         if schedule_is_active and not check_if_running(CONFIG):
             print("> Active schedule found for SelfControl!")
             print("> Start SelfControl (this could take a few minutes)\n")
-            run(OPTS.dir)
+            run(OPTS.dir, preloaded=CONFIG)
             print("\n> SelfControl was started.\n")
     else:
         exit_with_error(
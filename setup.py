@@ -8,5 +8,6 @@ setup(
     description='Small utility to schedule start and stop times of SelfControl',
     url='github.com/andreasgrill/auto-selfcontrol',
     long_description=open('README.md').read(),
-    install_requires=["pyobjc", "pyobjc-core"]
+    install_requires=["pyobjc", "pyobjc-core"],
+    extras_require={"speedups": ["orjson"]}
 )
\ No newline at end of file